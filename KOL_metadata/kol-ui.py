@@ -4,7 +4,12 @@
 
 #https://tczyjmj1w7.execute-api.us-east-1.amazonaws.com/Stage2/opensearch-api?get_kol_details=Alan%20Paul%20Venook
 
+#responses are plain JSON; enable minimumCompressionSize on the REST API so API Gateway gzips them for clients that ask
+
 import json
+import gzip
+import re
+import time
 import boto3
 import os
 from opensearchpy import OpenSearch, RequestsHttpConnection
@@ -26,13 +31,62 @@ opensearch = OpenSearch(
     connection_class=RequestsHttpConnection
 )
  
+# KOL snapshot published to S3 by metadata.py (see publish_kol_snapshot there)
+s3 = boto3.client("s3")
+KOL_SNAPSHOT_BUCKET = os.environ.get("S3_BUCKET")
+KOL_SNAPSHOT_PREFIX = "kol_snapshots/"
+SNAPSHOT_CHECK_INTERVAL = 60  # seconds between LATEST pointer checks
+ 
+# Cached per warm container, as decompressed JSON strings ready to return
+snapshot = {"version": None, "checked_at": 0, "list_body": None, "details": {}}
+ 
+def kol_key(name):
+    """Must match kol_key in metadata.py."""
+    name = re.sub(r"^dr\.?\s+", "", (name or "").strip().lower())
+    return re.sub(r"[^a-z0-9]+", "-", name).strip("-")
+ 
+def refresh_snapshot():
+    """Reload the list snapshot when the LATEST pointer moves. Returns False if no snapshot is available."""
+    now = time.time()
+    if now - snapshot["checked_at"] < SNAPSHOT_CHECK_INTERVAL:
+        return snapshot["version"] is not None
+    # Failed checks count too, so a missing snapshot or unset S3_BUCKET costs one S3 call per interval
+    snapshot["checked_at"] = now
+    try:
+        version = s3.get_object(Bucket=KOL_SNAPSHOT_BUCKET, Key=f"{KOL_SNAPSHOT_PREFIX}LATEST")["Body"].read().decode("utf-8").strip()
+        if version != snapshot["version"]:
+            obj = s3.get_object(Bucket=KOL_SNAPSHOT_BUCKET, Key=f"{KOL_SNAPSHOT_PREFIX}{version}/kols.json.gz")
+            snapshot["list_body"] = gzip.decompress(obj["Body"].read()).decode("utf-8")
+            snapshot["details"] = {}
+            snapshot["version"] = version
+    except Exception as e:
+        print("Error loading KOL snapshot:", str(e))
+    return snapshot["version"] is not None
+ 
+def get_detail_shard(kol_name):
+    """Detail document JSON for a KOL from the current snapshot, or None if it has no shard."""
+    key = kol_key(kol_name)
+    if key not in snapshot["details"]:
+        try:
+            obj = s3.get_object(Bucket=KOL_SNAPSHOT_BUCKET, Key=f"{KOL_SNAPSHOT_PREFIX}{snapshot['version']}/details/{key}.json.gz")
+            snapshot["details"][key] = gzip.decompress(obj["Body"].read()).decode("utf-8")
+        except s3.exceptions.NoSuchKey:
+            snapshot["details"][key] = None
+        except Exception as e:
+            # AccessDenied for missing keys without s3:ListBucket, throttling, network errors: don't cache
+            print("Error loading KOL detail shard:", str(e))
+            return None
+    return snapshot["details"][key]
+ 
 def lambda_handler(event, context):
-    query_params = event.get("queryStringParameters", {})
+    query_params = event.get("queryStringParameters") or {}
  
     print("Received Query Parameters:", query_params)
  
    
     if "get_all_kols" in query_params:
+        if refresh_snapshot():
+            return create_json_response(200, snapshot["list_body"])
         return get_all_kols()
  
    
@@ -40,6 +94,10 @@ def lambda_handler(event, context):
         kol_name = query_params.get("get_kol_details")
         if not kol_name:
             return create_response(400, {"error": "Missing kol_name parameter"})
+        if refresh_snapshot():
+            shard = get_detail_shard(kol_name)
+            if shard is not None:
+                return create_json_response(200, shard)
         return get_kol_details(kol_name)
  
    
@@ -108,3 +166,10 @@ def create_response(status_code, body):
         },
         "body": json.dumps(body, ensure_ascii=False)  
     }
+ 
+ 
+def create_json_response(status_code, json_body):
+    """Like create_response, for a body that is already serialized JSON."""
+    response = create_response(status_code, {})
+    response["body"] = json_body
+    return response
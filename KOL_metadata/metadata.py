@@ -5,12 +5,14 @@
 #OpenSearch – Storing the extracted and generated KOL details for future use.
 
 import json
+import gzip
 import requests
 import time
 import boto3
 import os
+import re
 import xml.etree.ElementTree as ET
-from opensearchpy import OpenSearch, RequestsHttpConnection
+from opensearchpy import OpenSearch, RequestsHttpConnection, helpers
 from requests_aws4auth import AWS4Auth
 from openai import OpenAI
  
@@ -30,6 +32,10 @@ opensearch = OpenSearch(
     connection_class=RequestsHttpConnection
 )
  
+s3 = boto3.client("s3")
+KOL_SNAPSHOT_BUCKET = os.environ.get("S3_BUCKET")
+KOL_SNAPSHOT_PREFIX = "kol_snapshots/"
+ 
 # OpenAI client initialization
 client = OpenAI(
     base_url="https://models.inference.ai.azure.com",
@@ -157,62 +163,223 @@ def fetch_pubmed_affiliation_and_collaborators_and_research(kol_name):
             "research": []
         }
  
+# Rough chars-per-token ratio for English text with GPT-4o's tokenizer
+CHARS_PER_TOKEN = 4
+CONTEXT_TOKEN_BUDGET = 600
+# Output token allowance per requested field, used to size max_tokens so long answers aren't cut off
+OUTPUT_TOKENS_PER_STRING = 40
+OUTPUT_TOKENS_PER_ARRAY = 150
+OUTPUT_TOKENS_PER_SUMMARY_WORD = 1.5
+NAME_SUFFIXES = {"jr", "sr", "ii", "iii", "iv"}
+ 
+# Fields the model has to fill in; anything already known from PubMed is dropped from the request
+AI_METADATA_FIELDS = {
+    "gender": ("string", "predict by name"),
+    "qualifications": ("array", ""),
+    "primary_affiliation": ("string", "remove electronic address if present"),
+    "country": ("string", "derive from primary affiliation, or use other sources if not available"),
+    "department": ("string", ""),
+    "title": ("string", "current title or position in single word"),
+    "email": ("string", "try to retrieve from primary affiliation if available or check verified sources sites"),
+    "phone": ("string", "check institutional or medical reference sites"),
+    "fax": ("string", "check institutional or medical reference sites"),
+    "twitter": ("string", "url, Twitter handle if available"),
+    "linkedin": ("string", "url, LinkedIn profile if available"),
+    "professional_summary": ("string", "300-500 words"),
+    "education": ("array", ""),
+    "professional_history": ("array", ""),
+    "conferences_and_awards": ("array", ""),
+    "areas_of_interest": ("array", ""),
+    "geographical_influence": ("array", "only locations in the format 'city, state, country', no duplicates"),
+    "speaking_engagements": ("array", "industry events participations, sources like clinicaltrials.gov, FirstWordPharma.com"),
+    "patient_advocacy": ("array", "involvement in patient advocacy, sources like aacr.org, liverfoundation.org, novartis.com, accc-cancer.org, and others")
+}
+ 
+def dedupe_and_truncate(values, token_budget=None):
+    """Drop duplicate strings (keeping first-seen order) and stop once the token budget is spent."""
+    seen = set()
+    kept = []
+    used = 0
+    for value in values:
+        value = (value or "").strip()
+        key = value.lower()
+        if not value or key in seen:
+            continue
+        cost = len(value) // CHARS_PER_TOKEN + 1
+        if token_budget is not None and used + cost > token_budget:
+            break
+        seen.add(key)
+        kept.append(value)
+        used += cost
+    return kept
+ 
+def clean_affiliation(affiliation):
+    """Strip the trailing 'Electronic address: ...' PubMed appends to affiliations."""
+    return re.split(r"\.?\s*Electronic address:", affiliation)[0].strip()
+ 
+def build_metadata_schema(fields):
+    """Build a strict JSON schema for the requested metadata fields."""
+    properties = {}
+    for field in fields:
+        kind, _ = AI_METADATA_FIELDS[field]
+        if kind == "array":
+            properties[field] = {"type": "array", "items": {"type": "string"}}
+        else:
+            properties[field] = {"type": "string"}
+    return {
+        "name": "kol_metadata",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": properties,
+            "required": list(fields),
+            "additionalProperties": False
+        }
+    }
+ 
+def output_token_budget(fields):
+    """max_tokens for a response with these fields, with headroom for JSON syntax."""
+    budget = 0
+    for field in fields:
+        kind, _ = AI_METADATA_FIELDS[field]
+        if field == "professional_summary":
+            budget += int(500 * OUTPUT_TOKENS_PER_SUMMARY_WORD)
+        elif kind == "array":
+            budget += OUTPUT_TOKENS_PER_ARRAY
+        else:
+            budget += OUTPUT_TOKENS_PER_STRING
+    return int(budget * 1.25) + 100
+ 
+def name_signature(name):
+    """(last name, first initial) for matching "Alan P Venook" against "Alan Paul Venook"."""
+    parts = [part for part in re.sub(r"[^a-z\s-]", "", (name or "").lower()).split() if part not in NAME_SUFFIXES]
+    if not parts:
+        return None
+    return parts[-1], parts[0][0]
+ 
+class TopLevelKeyValidator:
+    """Incrementally scans streamed JSON and raises as soon as the output stops being an object or
+    a top-level key appears that isn't in the schema."""
+ 
+    def __init__(self, allowed_keys):
+        self.allowed_keys = set(allowed_keys)
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.string = []
+        self.pending_key = None
+ 
+    def feed(self, text):
+        for char in text:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        self.pending_key = "".join(self.string)
+                    continue
+                self.string.append(char)
+            elif char.isspace():
+                continue
+            elif self.depth == 0 and char != "{":
+                raise ValueError(f"AI model output is not a JSON object: {text[:50]!r}")
+            elif char == '"':
+                self.in_string = True
+                self.string = []
+            elif char == ":" and self.depth == 1 and self.pending_key is not None:
+                if self.pending_key not in self.allowed_keys:
+                    raise ValueError(f"AI model output has unexpected field: {self.pending_key!r}")
+                self.pending_key = None
+            else:
+                self.pending_key = None
+                if char in "{[":
+                    self.depth += 1
+                elif char in "}]":
+                    self.depth -= 1
+ 
+def stream_json_completion(messages, schema, max_tokens):
+    """Stream a JSON-mode completion, aborting mid-stream if the output isn't an object or has a
+    top-level key outside the schema. Truncation is only detected once the stream ends."""
+    stream = client.chat.completions.create(
+        messages=messages,
+        model="gpt-4o",
+        temperature=1,
+        max_tokens=max_tokens,
+        top_p=1,
+        response_format={"type": "json_schema", "json_schema": schema},
+        stream=True
+    )
+    validator = TopLevelKeyValidator(schema["schema"]["properties"])
+    parts = []
+    finish_reason = None
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            delta = choice.delta.content or ""
+            validator.feed(delta)
+            parts.append(delta)
+            finish_reason = choice.finish_reason or finish_reason
+    finally:
+        stream.close()
+ 
+    if finish_reason == "length":
+        raise ValueError("AI model output truncated at max_tokens")
+    return "".join(parts)
+ 
 def fetch_ai_metadata(kol_name, primary_affiliation, geographic_influence, collaborators):
-    prompt = f'''You are a data extraction assistant with backend development expertise. Your task is to generate and retrieve metadata for the Key Opinion Leader (KOL) of medical science, "Dr. {kol_name}", using the following details:
- 
-    Primary Affiliation: "{primary_affiliation}"
-    Geographic Influence: "{geographic_influence}"
-    Collaborators: "{collaborators}"
-    Access information using the name and primary affiliation of the KOL use much details to get all data possibly.
- 
-    Return a JSON object with the following structure:
-    {{
-        "full_name": "string",
-        "gender": "string (predict by name)",
-        "qualifications": ["array of strings"],
-        "primary_affiliation": "string (remove electronic address if present, otherwise use only primary affiliation if available other wise use any other source to get this)",
-        "country": "string (derive from primary affiliation, or use other sources if not available)",
-        "department": "string",
-        "title": "string (current title or position in single word)",
-        "email": "string (try to retrieve from primary affiliation if available or check verified sources sites)",
-        "phone": "string (check institutional or medical reference sites)",
-        "fax": "string (check institutional or medical reference sites)",
-        "twitter": "url (Twitter handle if available)",
-        "linkedin": "url (LinkedIn profile if available)",
-        "professional_summary": "string (300-500 words)",
-        "education": ["array of strings"],
-        "professional_history": ["array of strings"],
-        "conferences_and_awards": ["array of strings"],
-        "areas_of_interest": ["array of strings"],
-        "collaborators": ["array of strings (exclude KOL name, include other collaborators)]",
-        "geographical_influence": ["array of strings (only locations in the format 'city, state, country', no duplicates)]",
-        "speaking_engagements": ["array of strings (industry events participations, sources like clinicaltrials.gov, FirstWordPharma.com)]",
-        "patient_advocacy": ["array of strings (involvement in patient advocacy, sources like aacr.org, liverfoundation.org, novartis.com, accc-cancer.org, and others)]"
-    }}
+    primary_affiliation = (primary_affiliation or "").strip()
+    affiliation_known = (
+        primary_affiliation not in ("", "Not available", "Affiliation not found")
+        and not primary_affiliation.startswith("Error fetching")
+    )
+    requested_fields = [
+        field for field in AI_METADATA_FIELDS
+        if not (field == "primary_affiliation" and affiliation_known)
+    ]
+ 
+    # Collaborators come straight from PubMed; the model only gets a deduplicated sample as context
+    kol_signature = name_signature(kol_name)
+    collaborators = [name for name in dedupe_and_truncate(collaborators) if name_signature(name) != kol_signature]
+    locations = dedupe_and_truncate(geographic_influence, CONTEXT_TOKEN_BUDGET)
+    collaborator_sample = dedupe_and_truncate(collaborators, CONTEXT_TOKEN_BUDGET // 3)
+    if affiliation_known:
+        primary_affiliation = clean_affiliation(primary_affiliation)
+    else:
+        primary_affiliation = "Not available"
+ 
+    field_hints = "\n".join(
+        f'    - {field}: {hint}' for field, (_, hint) in AI_METADATA_FIELDS.items()
+        if field in requested_fields and hint
+    )
+    prompt = f'''Generate metadata for the Key Opinion Leader (KOL) of medical science "Dr. {kol_name}".
+ 
+    Primary Affiliation: {primary_affiliation}
+    Affiliations on recent publications: {json.dumps(locations, ensure_ascii=False)}
+    Frequent co-authors: {json.dumps(collaborator_sample, ensure_ascii=False)}
+ 
+    Field notes:
+{field_hints}
     Guidelines:
     1.Use verified sources (institutional websites, PubMed, Google Scholar, ClinicalTrials.gov, Wikipedia).
     2.Insert "Not available" for missing fields.
-    3.Follow strict JSON format.
-    4.Escape special characters and ensure social media links and contacts are valid.
+    3.Ensure social media links and contacts are valid.
     '''
     try:
-        response = client.chat.completions.create(
-            messages=[{"role": "system", "content": "You are a helpful assistant generating structured JSON metadata."},
-                      {"role": "user", "content": prompt}],
-            model="gpt-4o",
-            temperature=1,
-            max_tokens=4000,
-            top_p=1
+        content = stream_json_completion(
+            [{"role": "system", "content": "You are a helpful assistant generating structured JSON metadata."},
+             {"role": "user", "content": prompt}],
+            build_metadata_schema(requested_fields),
+            output_token_budget(requested_fields)
         )
-        content = response.choices[0].message.content.strip()
-        # Extract JSON from content (assuming model might wrap it in markdown or extra text)
-        start_idx = content.find('{')
-        end_idx = content.rfind('}') + 1
-        if start_idx == -1 or end_idx == 0:
-            print(f"Invalid JSON response for {kol_name}: {content}")
-            return {"error": "Invalid JSON format from AI model"}
-        json_str = content[start_idx:end_idx]
-        return json.loads(json_str)
+        ai_metadata = json.loads(content)
+        missing = [field for field in requested_fields if field not in ai_metadata]
+        if missing:
+            return {"error": f"AI model response missing fields: {', '.join(missing)}"}
     except json.JSONDecodeError as e:
         print(f"JSON parsing error for {kol_name}: {str(e)} - Raw content: {content}")
         return {"error": f"JSON parsing failed: {str(e)}"}
@@ -220,10 +387,16 @@ def fetch_ai_metadata(kol_name, primary_affiliation, geographic_influence, colla
         print(f"Error in AI metadata fetch for {kol_name}: {str(e)}")
         return {"error": str(e)}
  
+    ai_metadata["full_name"] = f"Dr. {kol_name}"
+    ai_metadata["collaborators"] = collaborators
+    if affiliation_known:
+        ai_metadata["primary_affiliation"] = primary_affiliation
+    return ai_metadata
+ 
 def store_kol_details(kol_metadata):
-    """Store KOL details in OpenSearch."""
+    """Store KOL details in OpenSearch, keyed by KOL so reruns replace the previous document."""
     try:
-        opensearch.index(index="kol_details", body=kol_metadata)
+        opensearch.index(index="kol_details", id=kol_key(kol_metadata.get("full_name")), body=kol_metadata)
         return True
     except Exception as e:
         print(f"Error storing KOL details: {str(e)}")
@@ -267,6 +440,7 @@ def process_author_batch(author_batch):
         metadata = ai_metadata
         metadata["image_url"] = fetch_kol_image(f"Dr.{kol_name}")
         metadata["research"] = research
+        metadata["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
  
         if store_kol_details(metadata):
             kol_metadata_list.append(metadata)
@@ -275,6 +449,55 @@ def process_author_batch(author_batch):
    
     return kol_metadata_list
  
+def kol_key(name):
+    """Normalize a KOL name into the key used for detail shards ("Dr. Alan Paul Venook" -> "alan-paul-venook")."""
+    name = re.sub(r"^dr\.?\s+", "", (name or "").strip().lower())
+    return re.sub(r"[^a-z0-9]+", "-", name).strip("-")
+ 
+def put_gzip_json(key, data):
+    s3.put_object(
+        Bucket=KOL_SNAPSHOT_BUCKET,
+        Key=key,
+        Body=gzip.compress(json.dumps(data, ensure_ascii=False).encode("utf-8")),
+        ContentType="application/json",
+        ContentEncoding="gzip"
+    )
+ 
+def publish_kol_snapshot():
+    """Publish the full kol_details catalog to S3 as a versioned, gzipped list snapshot plus per-KOL detail shards.
+ 
+    Layout: kol_snapshots/<version>/kols.json.gz, kol_snapshots/<version>/details/<kol_key>.json.gz
+    and kol_snapshots/LATEST holding the current version, which kol-ui.py polls.
+    """
+    # Older runs indexed without an _id, so the same KOL can appear several times; keep the newest
+    latest = {}
+    for hit in helpers.scan(opensearch, index="kol_details", query={"query": {"match_all": {}}}, size=500):
+        doc = hit["_source"]
+        key = kol_key(doc.get("full_name"))
+        if key not in latest or doc.get("updated_at", "") >= latest[key].get("updated_at", ""):
+            latest[key] = doc
+ 
+    version = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    base = f"{KOL_SNAPSHOT_PREFIX}{version}/"
+ 
+    kols = []
+    for key, doc in latest.items():
+        kols.append({
+            "full_name": doc.get("full_name", "Unknown"),
+            "title": doc.get("title", "Not Available"),
+            "phone": doc.get("phone", "Not Available"),
+            "email": doc.get("email", "Not Available"),
+            "country": doc.get("country", "Not Available"),
+            "image_url": doc.get("image_url", "Not Available")
+        })
+        put_gzip_json(f"{base}details/{key}.json.gz", doc)
+    put_gzip_json(f"{base}kols.json.gz", {"version": version, "kols": kols})
+ 
+    # Flip the pointer last so readers never see a half-written snapshot
+    s3.put_object(Bucket=KOL_SNAPSHOT_BUCKET, Key=f"{KOL_SNAPSHOT_PREFIX}LATEST", Body=version.encode("utf-8"), ContentType="text/plain")
+    print(f"Published KOL snapshot {version} with {len(kols)} KOLs")
+    return version
+ 
 # Lambda handler
 def lambda_handler(event, context):
     try:
@@ -287,6 +510,14 @@ def lambda_handler(event, context):
             batch_metadata = process_author_batch(author_batch)
             kol_metadata_list.extend(batch_metadata)
  
+        # Make the freshly indexed catalog visible to the UI Lambda; kol-ui.py falls back to
+        # OpenSearch if this fails, so it shouldn't fail the enrichment run
+        try:
+            opensearch.indices.refresh(index="kol_details")
+            publish_kol_snapshot()
+        except Exception as e:
+            print(f"Error publishing KOL snapshot: {str(e)}")
+ 
         return {
             'statusCode': 200,
             'body': json.dumps(kol_metadata_list)
@@ -4,13 +4,18 @@
 
 
 import json
-import requests
+import asyncio
+import time
+import uuid
+import aiohttp
 import boto3
 import os
 import xml.etree.ElementTree as ET
 from datetime import datetime
+from functools import lru_cache
 import re
-from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
+from contextlib import contextmanager
+from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth, helpers
 
 # AWS Configuration
 S3_BUCKET_NAME = os.environ.get("S3_BUCKET")
@@ -32,75 +37,122 @@ opensearch_client = OpenSearch(
 )
 
 INDEX_NAME = "articles_index"
-
-
-def fetch_pubmed_articles(search_term, start_date, end_date, max_studies):
-    """Fetch article IDs from PubMed based on search criteria."""
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
-    params = {
-        "db": "pubmed",
-        "term": search_term,
-        "retmax": max_studies,
-        "datetype": "pdat",
-        "mindate": start_date,
-        "maxdate": end_date,
-        "retmode": "json"
+# Pre-bulk settings are parked under this _meta key while a bulk load runs
+BULK_LOAD_META_KEY = "bulk_load"
+LAMBDA_MAX_RUNTIME = 15 * 60  # seconds
+
+DEAD_LETTER_PREFIX = "dead_letter/pubmed/"
+# Set to a directory to use a local file store instead of S3, e.g. in tests
+DEAD_LETTER_DIR = os.environ.get("DEAD_LETTER_DIR")
+
+EUTILS_BASE = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+NCBI_API_KEY = os.environ.get("NCBI_API_KEY")
+# NCBI allows 3 requests/second without an API key and 10 with one, shared across all terms
+NCBI_REQUESTS_PER_SECOND = 10 if NCBI_API_KEY else 3
+EFETCH_PAGE_SIZE = 200
+MAX_RETRIES = 5
+
+# Explicit mappings so new articles never add dynamic fields; unknown fields stay in _source only
+ARTICLES_INDEX_TEMPLATE = {
+    "index_patterns": [INDEX_NAME],
+    "template": {
+        "mappings": {
+            "dynamic": False,
+            "properties": {
+                "article_id": {"type": "keyword"},
+                "article_title": {"type": "text"},
+                "web_article_url": {"type": "keyword", "index": False, "doc_values": False},
+                "authors": {"type": "text", "fields": {"raw": {"type": "keyword", "ignore_above": 256}}},
+                "article_type": {"type": "keyword"},
+                "time_date": {"type": "date", "format": "yyyy-MM-dd", "ignore_malformed": True},
+                "status": {"type": "keyword"},
+                "article_text": {"type": "text"},
+                "article_summary": {"type": "text"},
+                "keywords": {"type": "keyword", "ignore_above": 256}
+            }
+        }
     }
+}
 
-    response = requests.get(base_url, params=params)
-    if response.status_code != 200:
-        raise Exception(f"Error fetching data from PubMed API: {response.text}")
 
-    data = response.json()
-    return list(set(data.get("esearchresult", {}).get("idlist", [])))
+# Month names, abbreviations and numbers as they appear in PubDate/MedlineDate; seasons map to
+# the first month of the season
+MONTHS = {
+    "jan": 1, "feb": 2, "mar": 3, "apr": 4, "may": 5, "jun": 6,
+    "jul": 7, "aug": 8, "sep": 9, "oct": 10, "nov": 11, "dec": 12,
+    "spring": 3, "summer": 6, "fall": 9, "autumn": 9, "winter": 12,
+    **{str(n): n for n in range(1, 13)},
+    **{f"{n:02d}": n for n in range(1, 13)}
+}
 
 
-def fetch_articles_metadata(article_ids):
-    """Fetch metadata for multiple articles in one request."""
-    if not article_ids:
-        return {}
+def month_number(token):
+    """Resolve a month token ("Mar", "March", "03", "Winter") to 1-12, or None."""
+    token = token.lower()
+    return MONTHS.get(token) or MONTHS.get(token[:3])
 
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi"
-    params = {
-        "db": "pubmed",
-        "id": ",".join(article_ids),
-        "retmode": "json"
-    }
 
-    response = requests.get(base_url, params=params)
-    if response.status_code != 200:
-        return {}
+def iso_date(year, month=1, day=1):
+    """Format as YYYY-MM-DD. An unknown month falls back to January 1st, an impossible day to the
+    first of the month."""
+    if not month or not 1 <= month <= 12:
+        month, day = 1, 1
+    try:
+        return datetime(int(year), month, int(day or 1)).strftime("%Y-%m-%d")
+    except ValueError:
+        return f"{int(year):04d}-{month:02d}-01"
+
 
-    return response.json().get("result", {})
+# Precompiled shapes, tried in order; each handler gets the match groups
+DATE_PATTERNS = [
+    (re.compile(r"^(\d{4})[-/](\d{1,2})[-/](\d{1,2})$"), lambda y, m, d: iso_date(y, int(m), d)),
+    (re.compile(r"^(\d{4})[ -]([A-Za-z]+)[ -](\d{1,2})\b"), lambda y, m, d: iso_date(y, month_number(m), d)),
+    (re.compile(r"^([A-Za-z]+) (\d{1,2}), (\d{4})$"), lambda m, d, y: iso_date(y, month_number(m), d)),
+    (re.compile(r"^(\d{4})[ -]([A-Za-z]+)"), lambda y, m: iso_date(y, month_number(m))),
+    (re.compile(r"^(\d{4})-(\d{1,2})$"), lambda y, m: iso_date(y, int(m))),
+    (re.compile(r"^(\d{4})\b"), lambda y: iso_date(y))
+]
 
 
+@lru_cache(maxsize=4096)
 def format_date(date_str):
-    """Ensure the date is in 'YYYY-MM-DD' format."""
+    """Normalize a PubMed date string ("2023 Mar 15", "2022 Winter", "1998 Dec-1999 Jan", ...) to 'YYYY-MM-DD'."""
     if not date_str or date_str == "N/A":
         return "N/A"
 
-    formats = [
-        "%Y-%m-%d", "%Y/%m/%d", "%Y %b %d", "%b %d, %Y",
-        "%Y %B %d", "%Y-%b-%d", "%Y %b", "%Y-%m"
-    ]
+    date_str = " ".join(date_str.split())
+    for pattern, handler in DATE_PATTERNS:
+        match = pattern.match(date_str)
+        if match:
+            return handler(*match.groups())
+    return "N/A"
 
-    for fmt in formats:
-        try:
-            date_obj = datetime.strptime(date_str, fmt)
-            return date_obj.strftime("%Y-%m-%d")
-        except ValueError:
-            continue
 
-    match = re.match(r"^(\d{4}) (\w{3,})$", date_str)
-    if match:
-        year, month = match.groups()
-        try:
-            date_obj = datetime.strptime(f"{year} {month} 01", "%Y %b %d")
-            return date_obj.strftime("%Y-%m-%d")
-        except ValueError:
-            return f"{year}-01-01"
+@lru_cache(maxsize=4096)
+def normalize_pub_date(year, month, day, medline_date):
+    """Normalize the structured Year/Month (or Season)/Day children of a PubDate, or its MedlineDate."""
+    if year:
+        # Seasonal issues can span two ("Fall-Winter"); take the first
+        month = month_number(month.split("-")[0].strip()) if month else 1
+        return iso_date(year, month, day if day and day.isdigit() else 1)
+    return format_date(medline_date)
+
+
+def pub_date_of(article):
+    pub_date = article.find(".//PubDate")
+    if pub_date is None:
+        return "N/A"
+    return normalize_pub_date(
+        pub_date.findtext("Year"),
+        pub_date.findtext("Month") or pub_date.findtext("Season"),
+        pub_date.findtext("Day"),
+        pub_date.findtext("MedlineDate")
+    )
 
-    return "N/A"
+
+def normalize_pub_dates(articles):
+    """Batch API: normalized publication dates for a page of PubmedArticle elements, in order."""
+    return [pub_date_of(article) for article in articles]
 
 
 def summarize_text(text):
@@ -113,27 +165,15 @@ def summarize_text(text):
     return summary if summary else text
 
 
-def fetch_article_details(article_ids):
-    """Fetch full article details from PubMed, including authors and keywords."""
-    if not article_ids:
-        return {}
-
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
-    params = {
-        "db": "pubmed",
-        "id": ",".join(article_ids),
-        "retmode": "xml"
-    }
-
-    response = requests.get(base_url, params=params)
-    if response.status_code != 200:
-        return {}
-
+def parse_article_details(xml_text):
+    """Parse an efetch XML page into {article_id: details}."""
     details = {}
-    response_content = response.content.decode("utf-8", errors="replace")
-    root = ET.fromstring(response_content)
+    root = ET.fromstring(xml_text)
+
+    articles = root.findall(".//PubmedArticle")
+    pub_dates = normalize_pub_dates(articles)
 
-    for article in root.findall(".//PubmedArticle"):
+    for article, pub_date in zip(articles, pub_dates):
         article_id = article.find(".//PMID").text if article.find(".//PMID") is not None else "N/A"
         article_text = article.find(".//AbstractText").text if article.find(".//AbstractText") is not None else "N/A"
 
@@ -147,9 +187,6 @@ def fetch_article_details(article_ids):
 
         article_summary = conclusion if conclusion else summarize_text(article_text)
 
-        pub_date_element = article.find(".//PubDate")
-        pub_date = " ".join(pub_date_element.itertext()).strip() if pub_date_element is not None else "N/A"
-
         authors = []
         for author in article.findall(".//Author"):
             last_name = author.find(".//LastName").text if author.find(".//LastName") is not None else ""
@@ -168,7 +205,7 @@ def fetch_article_details(article_ids):
         details[article_id] = {
             "article_text": article_text,
             "article_summary": article_summary,
-            "pub_date": format_date(pub_date),
+            "pub_date": pub_date,
             "authors": authors,
             "keywords": keywords
         }
@@ -176,8 +213,133 @@ def fetch_article_details(article_ids):
     return details
 
 
+class NcbiRateLimiter:
+    """Spaces out request start times so every coroutine shares one NCBI rate budget."""
+
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def eutils_get(session, limiter, endpoint, params):
+    """GET an E-utilities endpoint under the shared rate budget, backing off on 429s."""
+    if NCBI_API_KEY:
+        params = {**params, "api_key": NCBI_API_KEY}
+    for attempt in range(MAX_RETRIES):
+        await limiter.wait()
+        async with session.get(f"{EUTILS_BASE}{endpoint}", params=params) as response:
+            if response.status == 429:
+                await asyncio.sleep(2 ** attempt)
+                continue
+            if response.status != 200:
+                raise Exception(f"Error fetching {endpoint} from PubMed API: {await response.text()}")
+            return await response.read()
+    raise Exception(f"Error fetching {endpoint} from PubMed API: rate limited after {MAX_RETRIES} retries")
+
+
+async def esearch_async(session, limiter, search_term, start_date, end_date, max_studies):
+    """Fetch PMIDs for one search term within a publication date window."""
+    params = {
+        "db": "pubmed",
+        "term": search_term,
+        "retmax": max_studies,
+        "datetype": "pdat",
+        "mindate": start_date,
+        "maxdate": end_date,
+        "retmode": "json"
+    }
+    data = json.loads(await eutils_get(session, limiter, "esearch.fcgi", params))
+    return data.get("esearchresult", {}).get("idlist", [])
+
+
+async def fetch_page_async(session, limiter, page_ids):
+    """Fetch esummary and efetch for one page of PMIDs concurrently, then parse the page."""
+    id_param = ",".join(page_ids)
+    summary_body, efetch_body = await asyncio.gather(
+        eutils_get(session, limiter, "esummary.fcgi", {"db": "pubmed", "id": id_param, "retmode": "json"}),
+        eutils_get(session, limiter, "efetch.fcgi", {"db": "pubmed", "id": id_param, "retmode": "xml"})
+    )
+    metadata = json.loads(summary_body).get("result", {})
+    details = parse_article_details(efetch_body.decode("utf-8", errors="replace"))
+    return metadata, details
+
+
+async def search_async(session, limiter, queries):
+    """Run esearch for every (search term, date window, max_studies) query concurrently and dedupe
+    the PMIDs across them. Returns (unique_ids, failures); a failed query becomes an esearch failure
+    record instead of failing the others."""
+    results = await asyncio.gather(
+        *[esearch_async(session, limiter, term, window["start_date"], window["end_date"], max_studies)
+          for term, window, max_studies in queries],
+        return_exceptions=True
+    )
+    unique_ids = []
+    seen = set()
+    failures = []
+    for (term, window, max_studies), result in zip(queries, results):
+        if isinstance(result, Exception):
+            print(f"Error searching PubMed for {term} ({window['start_date']} - {window['end_date']}): {str(result)}")
+            failures.append({
+                "stage": "esearch", "search_term": term, "start_date": window["start_date"],
+                "end_date": window["end_date"], "max_studies": max_studies, "error": str(result)
+            })
+            continue
+        for article_id in result:
+            if article_id not in seen:
+                seen.add(article_id)
+                unique_ids.append(article_id)
+    return unique_ids, failures
+
+
+async def fetch_pages_async(session, limiter, article_ids):
+    """Fetch articles in efetch-sized pages concurrently. Returns (article_ids, metadata, details,
+    failures), where article_ids only covers pages that were fetched and each failed page becomes
+    an efetch failure record carrying its PMIDs."""
+    pages = [article_ids[i:i + EFETCH_PAGE_SIZE] for i in range(0, len(article_ids), EFETCH_PAGE_SIZE)]
+    results = await asyncio.gather(
+        *[fetch_page_async(session, limiter, ids) for ids in pages],
+        return_exceptions=True
+    )
+    fetched_ids = []
+    articles_metadata = {}
+    detailed_info = {}
+    failures = []
+    for page_ids, result in zip(pages, results):
+        if isinstance(result, Exception):
+            print(f"Error fetching PubMed page of {len(page_ids)} articles starting at {page_ids[0]}: {str(result)}")
+            failures.append({"stage": "efetch", "article_ids": page_ids, "error": str(result)})
+            continue
+        metadata, details = result
+        fetched_ids.extend(page_ids)
+        articles_metadata.update(metadata)
+        detailed_info.update(details)
+    return fetched_ids, articles_metadata, detailed_info, failures
+
+
+async def fetch_articles_async(queries, article_ids=()):
+    """Run the esearch queries, add any explicitly given PMIDs, and fetch the unique articles under
+    one shared NCBI rate budget. Failed searches and pages are returned as failure records rather
+    than failing the run. Returns (article_ids, metadata, details, failures)."""
+    limiter = NcbiRateLimiter(NCBI_REQUESTS_PER_SECOND)
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=120)) as session:
+        unique_ids, search_failures = await search_async(session, limiter, queries)
+        seen = set(unique_ids)
+        unique_ids += [article_id for article_id in article_ids if article_id not in seen]
+        fetched_ids, articles_metadata, detailed_info, page_failures = await fetch_pages_async(session, limiter, unique_ids)
+    return fetched_ids, articles_metadata, detailed_info, search_failures + page_failures
+
+
 def upload_to_s3(file_name, data):
-    """Uploads JSON data to S3 bucket."""
+    """Uploads JSON data to S3 bucket. Returns the error message on failure, None on success."""
     try:
         s3_client.put_object(
             Bucket=S3_BUCKET_NAME,
@@ -188,48 +350,253 @@ def upload_to_s3(file_name, data):
         print(f"File uploaded to S3: {file_name}")
     except Exception as e:
         print(f"Error uploading {file_name} to S3: {str(e)}")
+        return str(e)
 
 
 def upload_to_opensearch(article_id, data):
-    """Uploads JSON data to OpenSearch."""
+    """Uploads JSON data to OpenSearch. Returns the error message on failure, None on success."""
     try:
         response = opensearch_client.index(index=INDEX_NAME, id=article_id, body=data)
         print(f"OpenSearch Upload Successful: {article_id}")
     except Exception as e:
         print(f"Error uploading {article_id} to OpenSearch: {str(e)}")
+        return str(e)
+
+
+def dead_letter(article_id, stage, error, payload_key=None, payload=None):
+    """One failed article: the stage it failed at, the error, and where its payload lives.
+    Payloads that never reached S3 are carried inline."""
+    record = {"article_id": article_id, "stage": stage, "error": error, "payload_key": payload_key}
+    if payload is not None:
+        record["payload"] = payload
+    return record
+
+
+def write_store(key, data):
+    """Write JSON to the dead-letter store: S3, or DEAD_LETTER_DIR when that is set."""
+    body = json.dumps(data, indent=4, ensure_ascii=False)
+    if DEAD_LETTER_DIR:
+        path = os.path.join(DEAD_LETTER_DIR, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(body)
+    else:
+        s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=key, Body=body, ContentType="application/json")
+
+
+def read_store(key):
+    if DEAD_LETTER_DIR:
+        with open(os.path.join(DEAD_LETTER_DIR, key), encoding="utf-8") as f:
+            return json.load(f)
+    return json.loads(s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key)["Body"].read().decode("utf-8"))
+
+
+def delete_store(key):
+    if DEAD_LETTER_DIR:
+        os.remove(os.path.join(DEAD_LETTER_DIR, key))
+    else:
+        s3_client.delete_object(Bucket=S3_BUCKET_NAME, Key=key)
+
+
+def save_dead_letters(dead_letters, key=None):
+    """Write failed items to the dead-letter store and return the key, or None if nothing failed.
+    Passing an existing key overwrites it (deleting it when dead_letters is empty)."""
+    if not dead_letters:
+        if key:
+            delete_store(key)
+        return None
+    key = key or f"{DEAD_LETTER_PREFIX}{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{uuid.uuid4().hex[:8]}.json"
+    write_store(key, dead_letters)
+    print(f"Recorded {len(dead_letters)} failed items in {key}")
+    return key
+
+
+def ensure_index_template():
+    """Install the articles_index template and create the index if it's missing. An index created
+    before the template keeps its dynamic mapping until it is reindexed."""
+    opensearch_client.indices.put_index_template(name=f"{INDEX_NAME}_template", body=ARTICLES_INDEX_TEMPLATE)
+    if not opensearch_client.indices.exists(index=INDEX_NAME):
+        opensearch_client.indices.create(index=INDEX_NAME)
+
+
+@contextmanager
+def bulk_load_mode(index_name):
+    """Disable refresh and replicas for a backfill and restore them afterwards.
+
+    The pre-bulk settings live in the index mapping's _meta rather than in this process, so an
+    overlapping run leaves settings alone (yields False) and a run that finds a stale owner restores
+    what that owner saved.
+    """
+    meta = opensearch_client.indices.get_mapping(index=index_name)[index_name]["mappings"].get("_meta", {})
+    owner = meta.get(BULK_LOAD_META_KEY)
+    if owner and time.time() - owner["started_at"] < LAMBDA_MAX_RUNTIME:
+        print(f"{index_name} is already in bulk-load mode, leaving its settings alone")
+        yield False
+        return
+    if owner:
+        # Owner is past the Lambda timeout, so it died mid-load; finish its job
+        saved = owner["settings"]
+    else:
+        current = opensearch_client.indices.get_settings(index=index_name)[index_name]["settings"]["index"]
+        if current.get("refresh_interval") == "-1":
+        # Disabled by something that didn't record its settings (manual change, older code); the
+        # real values are unknown, so don't touch them
+            print(f"{index_name} already has refresh disabled, leaving its settings alone")
+            yield False
+            return
+        saved = {
+            "refresh_interval": current.get("refresh_interval", "1s"),
+            "number_of_replicas": current.get("number_of_replicas", "1")
+        }
+    opensearch_client.indices.put_mapping(index=index_name, body={"_meta": {**meta, BULK_LOAD_META_KEY: {"settings": saved, "started_at": time.time()}}})
+    opensearch_client.indices.put_settings(index=index_name, body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+    try:
+        yield True
+    finally:
+        opensearch_client.indices.put_settings(index=index_name, body={"index": saved})
+        opensearch_client.indices.put_mapping(index=index_name, body={"_meta": {k: v for k, v in meta.items() if k != BULK_LOAD_META_KEY}})
+        opensearch_client.indices.refresh(index=index_name)
+
+
+def bulk_upload_to_opensearch(documents):
+    """Index {article_id: data} in bulk. Returns [(article_id, error)] for the documents that failed."""
+    actions = (
+        {"_index": INDEX_NAME, "_id": article_id, "_source": data}
+        for article_id, data in documents.items()
+    )
+    success, errors = helpers.bulk(opensearch_client, actions, chunk_size=500, raise_on_error=False)
+    failures = []
+    for error in errors:
+        print(f"Error bulk uploading to OpenSearch: {error}")
+        item = next(iter(error.values()))
+        failures.append((item.get("_id"), json.dumps(item.get("error"))))
+    return failures
+
+
+def store_article(article_id, article_data, dead_letters, bulk_documents=None):
+    """Upload one article to S3 and then OpenSearch (or queue it for bulk indexing),
+    recording a dead letter for whichever stage fails."""
+    file_name = f"pubmed_articles/{article_id}.json"
+    error = upload_to_s3(file_name, article_data)
+    if error:
+        dead_letters.append(dead_letter(article_id, "s3_upload", error, payload=article_data))
+        return
+    if bulk_documents is not None:
+        bulk_documents[article_id] = article_data
+        return
+    error = upload_to_opensearch(article_id, article_data)
+    if error:
+        dead_letters.append(dead_letter(article_id, "opensearch_upload", error, payload_key=file_name))
+
+
+def build_article_data(article_id, articles_metadata, detailed_info):
+    details = detailed_info.get(article_id, {})
+    return {
+        "article_id": article_id,
+        "article_title": articles_metadata.get(article_id, {}).get("title", "N/A"),
+        "web_article_url": f"https://pubmed.ncbi.nlm.nih.gov/{article_id}/",
+        "authors": details.get("authors", []),
+        "article_type": "Pubmed",
+        "time_date": details.get("pub_date", "N/A"),
+        "status": "published",
+        "article_text": details.get("article_text", "N/A"),
+        "article_summary": details.get("article_summary", "N/A"),
+        "keywords": details.get("keywords", [])
+    }
+
+
+def replay_dead_letters(key):
+    """Reprocess only the items recorded in a dead-letter object: failed searches and efetch pages
+    are refetched, failed uploads are retried from their payload. Items that fail again are written
+    back to the same key; the object is deleted once everything succeeds."""
+    remaining = []
+    queries = []
+    refetch_ids = []
+    for item in read_store(key):
+        if item["stage"] == "esearch":
+            window = {"start_date": item["start_date"], "end_date": item["end_date"]}
+            queries.append((item["search_term"], window, item["max_studies"]))
+            continue
+        if item["stage"] == "efetch":
+            refetch_ids.extend(item["article_ids"])
+            continue
+
+        article_id = item["article_id"]
+        try:
+            if item["stage"] == "s3_upload":
+                article_data = item["payload"]
+            else:
+                obj = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=item["payload_key"])
+                article_data = json.loads(obj["Body"].read().decode("utf-8"))
+        except Exception as e:
+            remaining.append({**item, "error": str(e)})
+            continue
+        if item["stage"] == "s3_upload":
+            store_article(article_id, article_data, remaining)
+        else:
+            error = upload_to_opensearch(article_id, article_data)
+            if error:
+                remaining.append({**item, "error": error})
+
+    if queries or refetch_ids:
+        article_ids, articles_metadata, detailed_info, fetch_failures = asyncio.run(
+            fetch_articles_async(queries, refetch_ids)
+        )
+        remaining.extend(fetch_failures)
+        for article_id in article_ids:
+            store_article(article_id, build_article_data(article_id, articles_metadata, detailed_info), remaining)
+
+    save_dead_letters(remaining, key)
+    return remaining
 
 
 def lambda_handler(event, context):
-    """AWS Lambda function to fetch PubMed articles and store in S3 & OpenSearch."""
+    """AWS Lambda function to fetch PubMed articles and store in S3 & OpenSearch.
+
+    Accepts either a single therapeutic_area/author_name with start_date/end_date, or lists in
+    search_terms and date_windows ([{"start_date": ..., "end_date": ...}]) for portfolio-wide pulls.
+    Failed searches, efetch pages and uploads are recorded in a dead-letter object; pass
+    {"replay": <key>} to reprocess just those.
+    """
     try:
-        search_term = event.get("therapeutic_area") or event.get("author_name")
-        start_date = event["start_date"]
-        end_date = event["end_date"]
-        max_studies = int(event["max_studies"])
+        if event.get("replay"):
+            remaining = replay_dead_letters(event["replay"])
+            return {"statusCode": 200, "body": json.dumps({"message": "Replay completed", "failed": len(remaining)})}
 
-        article_ids = fetch_pubmed_articles(search_term, start_date, end_date, max_studies)
-        articles_metadata = fetch_articles_metadata(article_ids)
-        detailed_info = fetch_article_details(article_ids)
+        search_terms = event.get("search_terms") or [event.get("therapeutic_area") or event.get("author_name")]
+        date_windows = event.get("date_windows") or [{"start_date": event["start_date"], "end_date": event["end_date"]}]
+        max_studies = int(event["max_studies"])
+        queries = [(term, window, max_studies) for term in search_terms for window in date_windows]
 
-        for article_id in article_ids:
-            article_data = {
-                "article_id": article_id,
-                "article_title": articles_metadata.get(article_id, {}).get("title", "N/A"),
-                "web_article_url": f"https://pubmed.ncbi.nlm.nih.gov/{article_id}/",
-                "authors": detailed_info.get(article_id, {}).get("authors", []),
-                "article_type": "Pubmed",
-                "time_date": detailed_info.get(article_id, {}).get("pub_date", "N/A"),
-                "status": "published",
-                "article_text": detailed_info.get(article_id, {}).get("article_text", "N/A"),
-                "article_summary": detailed_info.get(article_id, {}).get("article_summary", "N/A"),
-                "keywords": detailed_info.get(article_id, {}).get("keywords", [])
-            }
+        article_ids, articles_metadata, detailed_info, fetch_failures = asyncio.run(fetch_articles_async(queries))
 
-            file_name = f"pubmed_articles/{article_id}.json"
-            upload_to_s3(file_name, article_data)
-            upload_to_opensearch(article_id, article_data)
+        ensure_index_template()
+        bulk_load = bool(event.get("bulk_load"))
+        documents = {} if bulk_load else None
+        dead_letters = list(fetch_failures)
 
-        return {"statusCode": 200, "body": json.dumps({"message": "Articles saved to S3 and OpenSearch"})}
+        for article_id in article_ids:
+            article_data = build_article_data(article_id, articles_metadata, detailed_info)
+            store_article(article_id, article_data, dead_letters, documents)
+
+        if documents:
+            try:
+                with bulk_load_mode(INDEX_NAME):
+                    failures = bulk_upload_to_opensearch(documents)
+            except Exception as e:
+                # helpers.bulk only swallows per-document errors; on a transport or settings error
+                # nothing is known to be indexed, but every article is already in S3
+                print(f"Error bulk uploading to OpenSearch: {str(e)}")
+                failures = [(article_id, str(e)) for article_id in documents]
+            for article_id, error in failures:
+                dead_letters.append(dead_letter(article_id, "opensearch_upload", error, payload_key=f"pubmed_articles/{article_id}.json"))
+
+        dead_letter_key = save_dead_letters(dead_letters)
+        return {"statusCode": 200, "body": json.dumps({
+            "message": "Articles saved to S3 and OpenSearch",
+            "failed": len(dead_letters),
+            "dead_letter_key": dead_letter_key
+        })}
 
     except Exception as e:
         return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
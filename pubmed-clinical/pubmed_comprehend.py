@@ -1,9 +1,12 @@
 # this code fetches data from pubmed then the articles are processed in comprehend to find sentiment and entities
 
 import json
+import time
+import uuid
 import boto3
 import os
-from opensearchpy import OpenSearch, RequestsHttpConnection
+from contextlib import contextmanager
+from opensearchpy import OpenSearch, RequestsHttpConnection, helpers
 from requests_aws4auth import AWS4Auth
 
 # AWS Configurations
@@ -25,6 +28,113 @@ opensearch = OpenSearch(
     connection_class=RequestsHttpConnection
 )
 
+INDEX_NAME = "pubmed-articles"
+BULK_LOAD_META_KEY = "bulk_load"  # same _meta key as pubmed.py
+LAMBDA_MAX_RUNTIME = 15 * 60  # seconds
+BUCKET_NAME = "intheknow-25"
+DEAD_LETTER_PREFIX = "dead_letter/pubmed_comprehend/"
+# Point at a local directory to keep dead letters on disk instead of S3 (used when testing locally)
+DEAD_LETTER_DIR = os.environ.get("DEAD_LETTER_DIR")
+
+# Comprehend entity blobs are display-only apart from mention text/type/sentiment; everything else
+# stays in _source without creating fields
+ENTITIES_MAPPING = {
+    "type": "object",
+    "dynamic": False,
+    "properties": {
+        "Entities": {
+            "type": "object",
+            "dynamic": False,
+            "properties": {
+                "Mentions": {
+                    "type": "object",
+                    "dynamic": False,
+                    "properties": {
+                        "Text": {"type": "keyword", "ignore_above": 256},
+                        "Type": {"type": "keyword"},
+                        "MentionSentiment": {
+                            "type": "object",
+                            "dynamic": False,
+                            "properties": {"Sentiment": {"type": "keyword"}}
+                        }
+                    }
+                }
+            }
+        }
+    }
+}
+
+PUBMED_ARTICLES_TEMPLATE = {
+    "index_patterns": [INDEX_NAME],
+    "template": {
+        "mappings": {
+            "dynamic": False,
+            "properties": {
+                "article_id": {"type": "keyword"},
+                "article_title": {"type": "text"},
+                "web_article_url": {"type": "keyword", "index": False, "doc_values": False},
+                "authors": {"type": "text", "fields": {"raw": {"type": "keyword", "ignore_above": 256}}},
+                "article_type": {"type": "keyword"},
+                "time_date": {"type": "date", "format": "yyyy-MM-dd", "ignore_malformed": True},
+                "status": {"type": "keyword"},
+                "article_text": {"type": "text"},
+                "article_summary": {"type": "text"},
+                "article_category": {"type": "keyword"},
+                "keywords": {"type": "keyword", "ignore_above": 256},
+                "sentiment": {"type": "keyword"},
+                "positive_sentiment": {"type": "float"},
+                "negative_sentiment": {"type": "float"},
+                "neutral_sentiment": {"type": "float"},
+                "mixed_sentiment": {"type": "float"},
+                "article_text_entities": ENTITIES_MAPPING,
+                "article_summary_entities": ENTITIES_MAPPING
+            }
+        }
+    }
+}
+
+def ensure_index_template():
+    """Put the pubmed-articles index template and create the index on first run. Existing
+    indices need a reindex for the mappings to apply."""
+    opensearch.indices.put_index_template(name=f"{INDEX_NAME}-template", body=PUBMED_ARTICLES_TEMPLATE)
+    if not opensearch.indices.exists(index=INDEX_NAME):
+        opensearch.indices.create(index=INDEX_NAME)
+
+
+@contextmanager
+def bulk_load_mode(index_name):
+    """Switch the index to refresh -1 / 0 replicas while bulk indexing. Yields True if this run
+    owns bulk mode; see the pubmed.py copy for how ownership is tracked in _meta."""
+    meta = opensearch.indices.get_mapping(index=index_name)[index_name]["mappings"].get("_meta", {})
+    owner = meta.get(BULK_LOAD_META_KEY)
+    if owner and time.time() - owner["started_at"] < LAMBDA_MAX_RUNTIME:
+        print(f"{index_name} is already in bulk-load mode, leaving its settings alone")
+        yield False
+        return
+    if owner:
+        # Stale owner (older than any Lambda can run): reuse the settings it recorded
+        saved = owner["settings"]
+    else:
+        current = opensearch.indices.get_settings(index=index_name)[index_name]["settings"]["index"]
+        if current.get("refresh_interval") == "-1":
+        # Refresh already off with nothing recorded in _meta: we can't know what to restore
+            print(f"{index_name} already has refresh disabled, leaving its settings alone")
+            yield False
+            return
+        saved = {
+            "refresh_interval": current.get("refresh_interval", "1s"),
+            "number_of_replicas": current.get("number_of_replicas", "1")
+        }
+    opensearch.indices.put_mapping(index=index_name, body={"_meta": {**meta, BULK_LOAD_META_KEY: {"settings": saved, "started_at": time.time()}}})
+    opensearch.indices.put_settings(index=index_name, body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+    try:
+        yield True
+    finally:
+        opensearch.indices.put_settings(index=index_name, body={"index": saved})
+        opensearch.indices.put_mapping(index=index_name, body={"_meta": {k: v for k, v in meta.items() if k != BULK_LOAD_META_KEY}})
+        opensearch.indices.refresh(index=index_name)
+
+
 def extract_entities(text):
     if not text:
         return {"Entities": []}
@@ -57,76 +167,221 @@ def extract_entities(text):
     return entities
 
 
-def lambda_handler(event, context):
-    bucket_name = "intheknow-25"
-    folder_prefix = "pubmed_articles/"
+def build_document(file_key, article_data):
+    """Run Comprehend over one article and build its pubmed-articles document. Returns None for empty articles."""
+    article_text = article_data.get("article_text", "")
+    article_summary = article_data.get("article_summary", "")
 
-    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=folder_prefix)
+    if not article_text:
+        return None  # Skip empty articles
 
-    if "Contents" not in response:
-        return {"message": "No files found in S3 folder."}
+    # Sentiment Analysis
+    sentiment_response = comprehend.detect_sentiment(Text=article_text, LanguageCode="en")
+    sentiment_data = {
+        "sentiment": sentiment_response["Sentiment"],
+        "positive_sentiment": sentiment_response["SentimentScore"]["Positive"],
+        "negative_sentiment": sentiment_response["SentimentScore"]["Negative"],
+        "neutral_sentiment": sentiment_response["SentimentScore"]["Neutral"],
+        "mixed_sentiment": sentiment_response["SentimentScore"]["Mixed"],
+    }
+
+    # Validate time_date field
+    time_date = article_data.get("time_date", "")
+    if time_date in ["N/A", "", None]:
+        time_date = None  # Remove invalid dates
+
+    # Extract Entities
+    article_text_entities = extract_entities(article_text)
+    article_summary_entities = extract_entities(article_summary)
+
+    # Prepare document
+    return {
+        "article_id": file_key.split("/")[-1].split(".")[0],
+        "article_title": article_data.get("article_title"),
+        "web_article_url": article_data.get("web_article_url"),
+        "authors": article_data.get("authors"),
+        "article_type": article_data.get("article_type"),
+        "time_date": time_date,  # Only store valid dates
+        "status": article_data.get("status"),
+        "article_text": article_text,
+        "article_summary": article_summary,
+        "article_category": article_data.get("article_category"),
+        "keywords": article_data.get("keywords"),
+        **sentiment_data,
+        "article_text_entities": article_text_entities,
+        "article_summary_entities": article_summary_entities,
+    }
+
+
+def write_store(key, data):
+    """Write JSON to the dead-letter store (S3, or DEAD_LETTER_DIR when set)."""
+    body = json.dumps(data, indent=4, ensure_ascii=False)
+    if DEAD_LETTER_DIR:
+        path = os.path.join(DEAD_LETTER_DIR, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(body)
+    else:
+        s3.put_object(Bucket=BUCKET_NAME, Key=key, Body=body, ContentType="application/json")
+
+
+def read_store(key):
+    if DEAD_LETTER_DIR:
+        with open(os.path.join(DEAD_LETTER_DIR, key), encoding="utf-8") as f:
+            return json.load(f)
+    return json.loads(s3.get_object(Bucket=BUCKET_NAME, Key=key)["Body"].read().decode("utf-8"))
+
+
+def delete_store(key):
+    if DEAD_LETTER_DIR:
+        os.remove(os.path.join(DEAD_LETTER_DIR, key))
+    else:
+        s3.delete_object(Bucket=BUCKET_NAME, Key=key)
 
-    opensearch_responses = []
-    
-    for file in response["Contents"]:
-        file_key = file["Key"]
-        if file_key.endswith("/"):
-            continue  # Skip folders
 
+def dead_letter(file_key, stage, error, doc=None):
+    """One failed article: the stage it failed at, the error, and the S3 key of its source payload.
+    For indexing failures the built document is kept too (doc_key), so replay skips Comprehend."""
+    article_id = file_key.split("/")[-1].split(".")[0]
+    record = {"article_id": article_id, "stage": stage, "error": error, "payload_key": file_key}
+    if doc is not None:
+        doc_key = f"{DEAD_LETTER_PREFIX}docs/{article_id}.json"
+        try:
+            write_store(doc_key, doc)
+            record["doc_key"] = doc_key
+        except Exception as e:
+            # Replay falls back to rebuilding the document from payload_key
+            print(f"Error storing built document for {file_key}: {str(e)}")
+    return record
+
+
+def save_dead_letters(dead_letters, key=None):
+    """Write failed items to the dead-letter store and return the key, or None if nothing failed.
+    Passing an existing key overwrites it (deleting it when dead_letters is empty)."""
+    if not dead_letters:
+        if key:
+            delete_store(key)
+        return None
+    key = key or f"{DEAD_LETTER_PREFIX}{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{uuid.uuid4().hex[:8]}.json"
+    write_store(key, dead_letters)
+    print(f"Recorded {len(dead_letters)} failed articles in {key}")
+    return key
+
+
+def index_documents(docs, bulk_load=False):
+    """Index {file_key: doc} into pubmed-articles. Returns the dead letters for documents that failed."""
+    dead_letters = []
+    if not bulk_load:
+        for file_key, doc in docs.items():
+            try:
+                opensearch.index(index=INDEX_NAME, body=doc, id=doc["article_id"])
+            except Exception as e:
+                print(f"Error indexing {file_key} into {INDEX_NAME}: {str(e)}")
+                dead_letters.append(dead_letter(file_key, "opensearch_index", str(e), doc))
+        return dead_letters
+
+    by_id = {doc["article_id"]: (file_key, doc) for file_key, doc in docs.items()}
+    actions = [{"_index": INDEX_NAME, "_id": article_id, "_source": doc} for article_id, (_, doc) in by_id.items()]
+    try:
+        with bulk_load_mode(INDEX_NAME):
+            success, errors = helpers.bulk(opensearch, actions, chunk_size=200, raise_on_error=False)
+    except Exception as e:
+        # Transport errors and settings calls still raise; treat every queued document as failed
+        # (re-indexing is idempotent by _id, so replaying ones that did land is harmless)
+        print(f"Error bulk indexing into {INDEX_NAME}: {str(e)}")
+        return [dead_letter(file_key, "opensearch_index", str(e), doc) for file_key, doc in by_id.values()]
+    for error in errors:
+        print(f"Error bulk indexing into {INDEX_NAME}: {error}")
+        item = next(iter(error.values()))
+        file_key, doc = by_id[item.get("_id")]
+        dead_letters.append(dead_letter(file_key, "opensearch_index", json.dumps(item.get("error")), doc))
+    return dead_letters
+
+
+def process_files(file_keys, bulk_load=False):
+    """Run Comprehend and index each article, isolating failures per file. Returns the dead letters."""
+    dead_letters = []
+    docs = {}
+
+    for file_key in file_keys:
         print(f"Processing file: {file_key}")
 
         # Read File
-        obj = s3.get_object(Bucket=bucket_name, Key=file_key)
-        article_data = json.loads(obj["Body"].read().decode("utf-8"))
-        article_text = article_data.get("article_text", "")
-        article_summary = article_data.get("article_summary", "")
-
-        if not article_text:
-            continue  # Skip empty articles
-
-        # Sentiment Analysis
-        sentiment_response = comprehend.detect_sentiment(Text=article_text, LanguageCode="en")
-        sentiment_data = {
-            "sentiment": sentiment_response["Sentiment"],
-            "positive_sentiment": sentiment_response["SentimentScore"]["Positive"],
-            "negative_sentiment": sentiment_response["SentimentScore"]["Negative"],
-            "neutral_sentiment": sentiment_response["SentimentScore"]["Neutral"],
-            "mixed_sentiment": sentiment_response["SentimentScore"]["Mixed"],
-        }
+        try:
+            obj = s3.get_object(Bucket=BUCKET_NAME, Key=file_key)
+            article_data = json.loads(obj["Body"].read().decode("utf-8"))
+        except Exception as e:
+            print(f"Error reading {file_key}: {str(e)}")
+            dead_letters.append(dead_letter(file_key, "s3_read", str(e)))
+            continue
 
-        # Validate time_date field
-        time_date = article_data.get("time_date", "")
-        if time_date in ["N/A", "", None]:
-            time_date = None  # Remove invalid dates
-
-        # Extract Entities
-        article_text_entities = extract_entities(article_text)
-        article_summary_entities = extract_entities(article_summary)
-
-        # Prepare document
-        doc = {
-            "article_id": file_key.split("/")[-1].split(".")[0],
-            "article_title": article_data.get("article_title"),
-            "web_article_url": article_data.get("web_article_url"),
-            "authors": article_data.get("authors"),
-            "article_type": article_data.get("article_type"),
-            "time_date": time_date,  # Only store valid dates
-            "status": article_data.get("status"),
-            "article_text": article_text,
-            "article_summary": article_summary,
-            "article_category": article_data.get("article_category"),
-            "keywords": article_data.get("keywords"),
-            **sentiment_data,
-            "article_text_entities": article_text_entities,
-            "article_summary_entities": article_summary_entities,
-        }
+        try:
+            doc = build_document(file_key, article_data)
+        except Exception as e:
+            print(f"Error running Comprehend on {file_key}: {str(e)}")
+            dead_letters.append(dead_letter(file_key, "comprehend", str(e)))
+            continue
+        if doc is not None:
+            docs[file_key] = doc
+
+    return dead_letters + index_documents(docs, bulk_load)
+
+
+def replay_dead_letters(key, bulk_load=False):
+    """Reprocess only the items in a dead-letter object: indexing failures with a stored document
+    are just re-indexed, everything else goes back through Comprehend. Items that fail again are
+    written back to the same key; the object is deleted once everything succeeds."""
+    file_keys = []
+    docs = {}
+    doc_keys = {}
+    remaining = []
+    for item in read_store(key):
+        if item["stage"] == "opensearch_index" and item.get("doc_key"):
+            try:
+                docs[item["payload_key"]] = read_store(item["doc_key"])
+                doc_keys[item["payload_key"]] = item["doc_key"]
+                continue
+            except Exception as e:
+                print(f"Error loading built document {item['doc_key']}: {str(e)}")
+        file_keys.append(item["payload_key"])
+
+    remaining.extend(process_files(file_keys, bulk_load))
+    failed = index_documents(docs, bulk_load)
+    remaining.extend(failed)
+    failed_keys = {item["payload_key"] for item in failed}
+    for file_key, doc_key in doc_keys.items():
+        if file_key not in failed_keys:
+            delete_store(doc_key)
+
+    save_dead_letters(remaining, key)
+    return remaining
+
+
+def lambda_handler(event, context):
+    """Process every article under pubmed_articles/, or with {"replay": <dead-letter key>} only the
+    articles that failed in an earlier run."""
+    event = event or {}
+    folder_prefix = "pubmed_articles/"
+    bulk_load = bool(event.get("bulk_load"))
+    ensure_index_template()
+
+    if event.get("replay"):
+        remaining = replay_dead_letters(event["replay"], bulk_load)
+        return {"message": "Replay completed.", "failed": len(remaining)}
+
+    response = s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=folder_prefix)
+
+    if "Contents" not in response:
+        return {"message": "No files found in S3 folder."}
 
-        # Index document in OpenSearch
-        index_name = "pubmed-articles"
-        os_response = opensearch.index(index=index_name, body=doc, id=doc["article_id"])
-        opensearch_responses.append(os_response)
+    file_keys = [file["Key"] for file in response["Contents"] if not file["Key"].endswith("/")]  # Skip folders
+    dead_letters = process_files(file_keys, bulk_load)
     
-    return {"message": "Processing completed successfully."}
+    return {
+        "message": "Processing completed successfully.",
+        "failed": len(dead_letters),
+        "dead_letter_key": save_dead_letters(dead_letters)
+    }
 
 
 
@@ -0,0 +1,136 @@
+import importlib
+import io
+import json
+import os
+import sys
+import xml.etree.ElementTree as ET
+from unittest import mock
+
+import pytest
+
+
+@pytest.fixture
+def pubmed_lambda(monkeypatch, tmp_path):
+    """pubmed with AWS/HTTP clients replaced and dead letters kept in tmp_path."""
+    for name in ["aiohttp", "boto3", "opensearchpy"]:
+        monkeypatch.setitem(sys.modules, name, mock.MagicMock())
+    monkeypatch.delitem(sys.modules, "pubmed", raising=False)
+    module = importlib.import_module("pubmed")
+    monkeypatch.setattr(module, "DEAD_LETTER_DIR", str(tmp_path))
+    return module
+
+
+def test_dead_letter_record_replay_delete(pubmed_lambda, tmp_path):
+    s3_objects = {}
+    s3_up = False
+
+    def put_object(Bucket, Key, Body, ContentType):
+        if Key.endswith("/1.json") and not s3_up:
+            raise RuntimeError("SlowDown")
+        s3_objects[Key] = Body
+
+    pubmed_lambda.s3_client.put_object.side_effect = put_object
+    pubmed_lambda.s3_client.get_object.side_effect = lambda Bucket, Key: {"Body": io.BytesIO(s3_objects[Key].encode())}
+    pubmed_lambda.opensearch_client.index.side_effect = RuntimeError("ConnectionError")
+
+    dead_letters = []
+    pubmed_lambda.store_article("1", {"article_id": "1"}, dead_letters)
+    pubmed_lambda.store_article("2", {"article_id": "2"}, dead_letters)
+    key = pubmed_lambda.save_dead_letters(dead_letters)
+
+    records = {record["article_id"]: record for record in pubmed_lambda.read_store(key)}
+    assert records["1"]["stage"] == "s3_upload"
+    assert records["1"]["payload"] == {"article_id": "1"}
+    assert records["2"]["stage"] == "opensearch_upload"
+    assert records["2"]["payload_key"] == "pubmed_articles/2.json"
+
+    s3_up = True
+    pubmed_lambda.opensearch_client.index.side_effect = None
+    assert pubmed_lambda.replay_dead_letters(key) == []
+
+    assert json.loads(s3_objects["pubmed_articles/1.json"]) == {"article_id": "1"}
+    assert {call.kwargs["id"] for call in pubmed_lambda.opensearch_client.index.call_args_list} == {"1", "2"}
+    assert not os.path.exists(tmp_path / key)
+
+
+
+def test_failed_search_and_page_are_replayed(pubmed_lambda, tmp_path, monkeypatch):
+    monkeypatch.setattr(pubmed_lambda, "EFETCH_PAGE_SIZE", 2)
+    monkeypatch.setattr(pubmed_lambda, "NCBI_REQUESTS_PER_SECOND", 1000)
+    ncbi_down = {"oncology", "3"}
+    fetched = []
+
+    async def esearch_async(session, limiter, search_term, start_date, end_date, max_studies):
+        if search_term in ncbi_down:
+            raise RuntimeError("502 Bad Gateway")
+        return {"cardiology": ["1", "2", "3"], "oncology": ["3", "4"]}[search_term]
+
+    async def fetch_page_async(session, limiter, page_ids):
+        if ncbi_down.intersection(page_ids):
+            raise RuntimeError("efetch timed out")
+        fetched.extend(page_ids)
+        return {i: {"title": f"title {i}"} for i in page_ids}, {i: {"pub_date": "2023-01-01"} for i in page_ids}
+
+    monkeypatch.setattr(pubmed_lambda, "esearch_async", esearch_async)
+    monkeypatch.setattr(pubmed_lambda, "fetch_page_async", fetch_page_async)
+    stored = []
+    monkeypatch.setattr(pubmed_lambda, "store_article", lambda article_id, data, dead_letters, bulk=None: stored.append(article_id))
+
+    response = pubmed_lambda.lambda_handler({
+        "search_terms": ["cardiology", "oncology"], "start_date": "2023", "end_date": "2024", "max_studies": 10
+    }, None)
+    body = json.loads(response["body"])
+    records = pubmed_lambda.read_store(body["dead_letter_key"])
+    assert sorted(record["stage"] for record in records) == ["efetch", "esearch"]
+    assert next(r for r in records if r["stage"] == "efetch")["article_ids"] == ["3"]
+    assert stored == ["1", "2"]
+
+    ncbi_down.clear()
+    fetched.clear()
+    stored.clear()
+    assert pubmed_lambda.replay_dead_letters(body["dead_letter_key"]) == []
+
+    # Only the failed search's results and the failed page are fetched again, each PMID once
+    assert sorted(fetched) == ["3", "4"]
+    assert sorted(stored) == ["3", "4"]
+    assert not os.path.exists(tmp_path / body["dead_letter_key"])
+
+
+@pytest.mark.parametrize("date_str, expected", [
+    ("2023 Mar 15", "2023-03-15"),
+    ("2023 Mar", "2023-03-01"),
+    ("2023-07-04", "2023-07-04"),
+    ("2023/7/4", "2023-07-04"),
+    ("Mar 5, 2020", "2020-03-05"),
+    ("2021-07", "2021-07-01"),
+    ("2019", "2019-01-01"),
+    ("2022 Winter", "2022-12-01"),
+    ("2023 Mar-Apr", "2023-03-01"),
+    ("2023 Mar 15-21", "2023-03-15"),
+    ("1998 Dec-1999 Jan", "1998-12-01"),
+    ("2023-02-30", "2023-02-01"),
+    ("2023-13-01", "2023-01-01"),
+    ("N/A", "N/A"),
+    ("", "N/A"),
+    ("in press", "N/A"),
+])
+def test_format_date(pubmed_lambda, date_str, expected):
+    assert pubmed_lambda.format_date(date_str) == expected
+
+
+@pytest.mark.parametrize("pub_date_xml, expected", [
+    ("<PubDate><Year>2023</Year><Month>Mar</Month><Day>05</Day></PubDate>", "2023-03-05"),
+    ("<PubDate><Year>2023</Year><Month>06</Month></PubDate>", "2023-06-01"),
+    ("<PubDate><Year>2023</Year></PubDate>", "2023-01-01"),
+    ("<PubDate><Year>2022</Year><Season>Winter</Season></PubDate>", "2022-12-01"),
+    ("<PubDate><Year>2022</Year><Season>Fall-Winter</Season></PubDate>", "2022-09-01"),
+    ("<PubDate><MedlineDate>2022 Spring</MedlineDate></PubDate>", "2022-03-01"),
+    ("<PubDate><MedlineDate>1998 Dec-1999 Jan</MedlineDate></PubDate>", "1998-12-01"),
+    ("<PubDate><Year>2023</Year><Month>Feb</Month><Day>30</Day></PubDate>", "2023-02-01"),
+    ("<PubDate><Year>2023</Year><Month>13</Month><Day>2</Day></PubDate>", "2023-01-01"),
+    ("", "N/A"),
+])
+def test_pub_date_of(pubmed_lambda, pub_date_xml, expected):
+    article = ET.fromstring(f"<PubmedArticle><Journal>{pub_date_xml}</Journal></PubmedArticle>")
+    assert pubmed_lambda.pub_date_of(article) == expected
+    assert pubmed_lambda.normalize_pub_dates([article, article]) == [expected, expected]
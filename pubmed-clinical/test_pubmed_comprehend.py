@@ -0,0 +1,76 @@
+import importlib
+import io
+import json
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+
+@pytest.fixture
+def comprehend_lambda(monkeypatch, tmp_path):
+    """pubmed_comprehend with AWS clients replaced and dead letters kept in tmp_path."""
+    monkeypatch.setenv("OPENSEARCH_HOST", "localhost")
+    for name in ["boto3", "opensearchpy", "requests_aws4auth"]:
+        monkeypatch.setitem(sys.modules, name, mock.MagicMock())
+    monkeypatch.delitem(sys.modules, "pubmed_comprehend", raising=False)
+    module = importlib.import_module("pubmed_comprehend")
+    monkeypatch.setattr(module, "DEAD_LETTER_DIR", str(tmp_path))
+
+    files = {
+        "pubmed_articles/1.json": {"article_text": "first"},
+        "pubmed_articles/2.json": {"article_text": "second"},
+    }
+    module.s3.list_objects_v2.return_value = {"Contents": [{"Key": key} for key in files]}
+    module.s3.get_object.side_effect = lambda Bucket, Key: {"Body": io.BytesIO(json.dumps(files[Key]).encode())}
+    return module
+
+
+def test_dead_letter_record_replay_delete(comprehend_lambda, tmp_path):
+    built = []
+    comprehend_failures = {"pubmed_articles/1.json"}
+    index_failures = {"2"}
+
+    def build_document(file_key, article_data):
+        built.append(file_key)
+        if file_key in comprehend_failures:
+            raise RuntimeError("ThrottlingException")
+        return {"article_id": file_key.split("/")[-1].split(".")[0]}
+
+    def index(index, body, id):
+        if id in index_failures:
+            raise RuntimeError("ConnectionError")
+
+    comprehend_lambda.build_document = build_document
+    comprehend_lambda.opensearch.index.side_effect = index
+
+    result = comprehend_lambda.lambda_handler({}, None)
+    key = result["dead_letter_key"]
+    assert result["failed"] == 2
+    records = {record["article_id"]: record for record in comprehend_lambda.read_store(key)}
+    assert records["1"]["stage"] == "comprehend"
+    assert records["2"]["stage"] == "opensearch_index"
+    assert os.path.exists(tmp_path / records["2"]["doc_key"])
+
+    comprehend_failures.clear()
+    index_failures.clear()
+    built.clear()
+    result = comprehend_lambda.lambda_handler({"replay": key}, None)
+
+    assert result["failed"] == 0
+    # Only the Comprehend failure is rebuilt; the indexing failure is re-indexed from its stored doc
+    assert built == ["pubmed_articles/1.json"]
+    assert not os.path.exists(tmp_path / key)
+    assert not os.path.exists(tmp_path / records["2"]["doc_key"])
+
+
+def test_bulk_transport_error_dead_letters_every_document(comprehend_lambda):
+    comprehend_lambda.build_document = lambda file_key, article_data: {"article_id": file_key.split("/")[-1].split(".")[0]}
+    comprehend_lambda.helpers.bulk.side_effect = RuntimeError("ConnectionError")
+
+    result = comprehend_lambda.lambda_handler({"bulk_load": True}, None)
+
+    assert result["failed"] == 2
+    records = comprehend_lambda.read_store(result["dead_letter_key"])
+    assert {record["stage"] for record in records} == {"opensearch_index"}